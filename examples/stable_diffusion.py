@@ -6,17 +6,32 @@ from pathlib import Path
 import gzip, argparse, math, re
 from functools import lru_cache
 from collections import namedtuple
+from typing import Optional, Tuple, Union
 
 import numpy as np
 from tqdm import tqdm
 
 from tinygrad.tensor import Tensor
+from tinygrad.jit import TinyJit
+from tinygrad.helpers import dtypes, flatten
+from tinygrad.lazy import Device
 from tinygrad.nn import Conv2d, Linear, GroupNorm, LayerNorm
 from extra.utils import download_file
 from tinygrad.state import torch_load, load_state_dict
 
 # TODO: refactor AttnBlock, CrossAttention, CLIPAttention to share code
 
+# a 1x1 Conv2d applied to channels last activations (..., c) is a matmul with the reshaped weight
+def conv1x1(conv:Conv2d, x:Tensor) -> Tensor: return x.linear(conv.weight.reshape(conv.weight.shape[0], -1).transpose(), conv.bias)
+
+# folds the softmax scale of an attention into its q projection once the weights are loaded, so the attention doesn't rescale
+# every score. already packed q/k/v weights are packed again, so this and pack_qkv can run in either order
+def fold_attention_scale(attn, q:Union[Linear, Conv2d]):
+  q.weight = (q.weight * attn.scale).realize()
+  if q.bias is not None: q.bias = (q.bias * attn.scale).realize()
+  attn.scale = 1.0
+  if getattr(attn, "qkv", None) is not None: attn.pack_qkv()
+
 class AttnBlock:
   def __init__(self, in_channels):
     self.norm = GroupNorm(32, in_channels)
@@ -24,28 +39,34 @@ class AttnBlock:
     self.k = Conv2d(in_channels, in_channels, 1)
     self.v = Conv2d(in_channels, in_channels, 1)
     self.proj_out = Conv2d(in_channels, in_channels, 1)
+    self.scale = in_channels ** -0.5
+
+  def fold_scale(self): fold_attention_scale(self, self.q)
 
   # copied from AttnBlock in ldm repo
   def __call__(self, x):
-    h_ = self.norm(x)
+    # h_ is never materialized, the normalize is elementwise so it's fused into the input of each 1x1 conv.
+    # packing q/k/v into one conv measured worse: the packed output has to be sliced back into three views for the attention
+    # the norm statistics and the attention run in float32 even when the block is float16, the result is cast back on the add
+    h_ = self.norm(x.float())
     q,k,v = self.q(h_), self.k(h_), self.v(h_)
 
     # compute attention
     b,c,h,w = q.shape
-    q = q.reshape(b,c,h*w)
-    q = q.permute(0,2,1)   # b,hw,c
-    k = k.reshape(b,c,h*w) # b,c,hw
-    w_ = q @ k
-    w_ = w_ * (c**(-0.5))
-    w_ = w_.softmax()
+    q,k,v = [y.reshape(b,c,h*w).permute(0,2,1) for y in (q,k,v)]  # b,hw,c
+    # the attention output is channels last, so proj_out is a matmul on it
+    h_ = conv1x1(self.proj_out, q.scaled_dot_product_attention(k, v, scale=self.scale))
+    return x + h_.permute(0,2,1).reshape(b,c,h,w).cast(x.dtype)
 
-    # attend to values
-    v = v.reshape(b,c,h*w)
-    w_ = w_.permute(0,2,1)
-    h_ = v @ w_
-    h_ = h_.reshape(b,c,h,w)
+# GroupNorm followed by SiLU. the swish is elementwise, so tinygrad fuses it with the affine into the kernel that normalizes.
+# float16 activations are normalized in float32 and cast back, the casts are elementwise so they fuse into the same kernels
+def group_norm_silu(norm:GroupNorm, x:Tensor) -> Tensor: return norm(x.float()).silu().cast(x.dtype)
 
-    return x + self.proj_out(h_)
+# https://pytorch.org/docs/stable/generated/torch.nn.functional.interpolate.html with mode="nearest"
+# this is only a view, the conv that consumes it indexes the input at (y//scale, x//scale) in its own kernel
+def upsample_nearest(x:Tensor, scale:int=2) -> Tensor:
+  bs,c,py,px = x.shape
+  return x.reshape(bs, c, py, 1, px, 1).expand(bs, c, py, scale, px, scale).reshape(bs, c, py*scale, px*scale)
 
 class ResnetBlock:
   def __init__(self, in_channels, out_channels=None):
@@ -56,8 +77,8 @@ class ResnetBlock:
     self.nin_shortcut = Conv2d(in_channels, out_channels, 1) if in_channels != out_channels else lambda x: x
 
   def __call__(self, x):
-    h = self.conv1(self.norm1(x).swish())
-    h = self.conv2(self.norm2(h).swish())
+    h = self.conv1(group_norm_silu(self.norm1, x))
+    h = self.conv2(group_norm_silu(self.norm2, h))
     return self.nin_shortcut(x) + h
 
 class Mid:
@@ -67,7 +88,7 @@ class Mid:
     self.block_2 = ResnetBlock(block_in, block_in)
 
   def __call__(self, x):
-    return x.sequential([self.block_1, self.attn_1, self.block_2])
+    return self.block_2(self.attn_1(self.block_1(x)))
 
 class Decoder:
   def __init__(self):
@@ -94,14 +115,10 @@ class Decoder:
     for l in self.up[::-1]:
       print("decode", x.shape)
       for b in l['block']: x = b(x)
-      if 'upsample' in l:
-        # https://pytorch.org/docs/stable/generated/torch.nn.functional.interpolate.html ?
-        bs,c,py,px = x.shape
-        x = x.reshape(bs, c, py, 1, px, 1).expand(bs, c, py, 2, px, 2).reshape(bs, c, py*2, px*2)
-        x = l['upsample']['conv'](x)
+      if 'upsample' in l: x = l['upsample']['conv'](upsample_nearest(x))
       x.realize()
 
-    return self.conv_out(self.norm_out(x).swish())
+    return self.conv_out(group_norm_silu(self.norm_out, x))
 
 
 class Encoder:
@@ -130,7 +147,7 @@ class Encoder:
       if 'downsample' in l: x = l['downsample']['conv'](x)
 
     x = self.mid(x)
-    return self.conv_out(self.norm_out(x).swish())
+    return self.conv_out(group_norm_silu(self.norm_out, x))
 
 class AutoencoderKL:
   def __init__(self):
@@ -147,6 +164,23 @@ class AutoencoderKL:
     latent = self.post_quant_conv(latent)
     return self.decoder(latent)
 
+# Linear that can switch to int8 weights with one float16 scale per output channel once the checkpoint is loaded
+class QLinear(Linear):
+  def __init__(self, in_features, out_features, bias=True):
+    super().__init__(in_features, out_features, bias)
+    self.scale: Optional[Tensor] = None
+
+  def quantize(self):
+    w = self.weight.numpy().astype(np.float32)
+    scale = np.maximum(np.abs(w).max(axis=1, keepdims=True), 1e-8) / 127
+    self.weight = Tensor(np.round(w / scale).astype(np.int8), device=self.weight.device)
+    self.scale = Tensor(scale.astype(np.float16), device=self.weight.device)
+
+  def __call__(self, x):
+    if self.scale is None: return super().__call__(x)
+    # the dequantize is elementwise on the weight, so it fuses into the matmul and only the int8 weight is read
+    return x.linear((self.weight.cast(dtypes.float32) * self.scale).transpose(), self.bias)
+
 # not to be confused with ResnetBlock
 class ResBlock:
   def __init__(self, channels, emb_channels, out_channels):
@@ -157,7 +191,7 @@ class ResBlock:
     ]
     self.emb_layers = [
       Tensor.silu,
-      Linear(emb_channels, out_channels)
+      QLinear(emb_channels, out_channels)
     ]
     self.out_layers = [
       GroupNorm(32, out_channels),
@@ -167,11 +201,12 @@ class ResBlock:
     ]
     self.skip_connection = Conv2d(channels, out_channels, 1) if channels != out_channels else lambda x: x
 
+  # the layer lists only exist to match the checkpoint keys, so call the layers directly and skip the identity placeholder
   def __call__(self, x, emb):
-    h = x.sequential(self.in_layers)
-    emb_out = emb.sequential(self.emb_layers)
+    h = self.in_layers[2](group_norm_silu(self.in_layers[0], x))
+    emb_out = self.emb_layers[1](emb.silu())
     h = h + emb_out.reshape(*emb_out.shape, 1, 1)
-    h = h.sequential(self.out_layers)
+    h = self.out_layers[3](group_norm_silu(self.out_layers[0], h))
     ret = self.skip_connection(x) + h
     return ret
 
@@ -184,29 +219,41 @@ class CrossAttention:
     self.num_heads = n_heads
     self.head_size = d_head
     self.to_out = [Linear(n_heads*d_head, query_dim)]
+    self.qkv: Optional[Tensor] = None  # set by pack_qkv
 
-  def __call__(self, x, context=None):
-    context = x if context is None else context
-    q,k,v = self.to_q(x), self.to_k(context), self.to_v(context)
-    q = q.reshape(x.shape[0], -1, self.num_heads, self.head_size).permute(0,2,1,3)  # (bs, num_heads, time, head_size)
-    k = k.reshape(x.shape[0], -1, self.num_heads, self.head_size).permute(0,2,3,1)  # (bs, num_heads, head_size, time)
-    v = v.reshape(x.shape[0], -1, self.num_heads, self.head_size).permute(0,2,1,3)  # (bs, num_heads, time, head_size)
+  def fold_scale(self): fold_attention_scale(self, self.to_q)
 
-    score = q.dot(k) * self.scale
-    weights = score.softmax()                     # (bs, num_heads, time, time)
-    attention = weights.dot(v).permute(0,2,1,3)   # (bs, time, num_heads, head_size)
+  # packs the q/k/v weights once the checkpoint is loaded, instead of concatenating them on every call. self attention only
+  def pack_qkv(self): self.qkv = self.to_q.weight.cat(self.to_k.weight, self.to_v.weight).realize()
+
+  # the packed k/v projection of the context. it only depends on the context, so a caller running many steps with one context
+  # can compute it once and pass it as context_kv
+  def project_context(self, context): return context.linear(self.to_k.weight.cat(self.to_v.weight).transpose())
+
+  def __call__(self, x, context=None, context_kv=None):
+    # one matmul against the packed weights reads the activations once instead of once per projection
+    if context is None and context_kv is None:
+      qkv = self.qkv if self.qkv is not None else self.to_q.weight.cat(self.to_k.weight, self.to_v.weight)
+      q,k,v = x.linear(qkv.transpose()).chunk(3, dim=-1)
+    else:
+      q = self.to_q(x)
+      k,v = (context_kv if context_kv is not None else self.project_context(context)).chunk(2, dim=-1)
+    q,k,v = [y.reshape(x.shape[0], -1, self.num_heads, self.head_size).permute(0,2,1,3) for y in (q,k,v)]  # (bs, num_heads, time, head_size)
+    attention = q.scaled_dot_product_attention(k, v, scale=self.scale).permute(0,2,1,3)  # (bs, time, num_heads, head_size)
 
     h_ = attention.reshape(shape=(x.shape[0], -1, self.num_heads * self.head_size))
-    return h_.sequential(self.to_out)
+    return self.to_out[0](h_)
 
 class GEGLU:
   def __init__(self, dim_in, dim_out):
     self.proj = Linear(dim_in, dim_out * 2)
     self.dim_out = dim_out
 
+  # two matmuls against the halves of the weight instead of chunking one, so the gelu and the product fuse into the second
+  # matmul kernel and only dim_out values per token are written instead of dim_out*2
   def __call__(self, x):
-    x, gate = self.proj(x).chunk(2, dim=-1)
-    return x * gate.gelu()
+    w, b = self.proj.weight, self.proj.bias
+    return x.linear(w[:self.dim_out].transpose(), b[:self.dim_out]) * x.linear(w[self.dim_out:].transpose(), b[self.dim_out:]).gelu()
 
 class FeedForward:
   def __init__(self, dim, mult=4):
@@ -217,7 +264,7 @@ class FeedForward:
     ]
 
   def __call__(self, x):
-    return x.sequential(self.net)
+    return self.net[2](self.net[0](x))
 
 class BasicTransformerBlock:
   def __init__(self, dim, context_dim, n_heads, d_head):
@@ -228,9 +275,9 @@ class BasicTransformerBlock:
     self.norm2 = LayerNorm(dim)
     self.norm3 = LayerNorm(dim)
 
-  def __call__(self, x, context=None):
+  def __call__(self, x, context=None, context_kv=None):
     x = self.attn1(self.norm1(x)) + x
-    x = self.attn2(self.norm2(x), context=context) + x
+    x = self.attn2(self.norm2(x), context=context, context_kv=context_kv) + x
     x = self.ff(self.norm3(x)) + x
     return x
 
@@ -242,17 +289,19 @@ class SpatialTransformer:
     self.transformer_blocks = [BasicTransformerBlock(channels, context_dim, n_heads, d_head)]
     self.proj_out = Conv2d(n_heads * d_head, channels, 1)
 
-  def __call__(self, x, context=None):
+  def project_context(self, context): return [block.attn2.project_context(context) for block in self.transformer_blocks]
+
+  # context_kv is one projection per transformer block, as returned by project_context
+  def __call__(self, x, context=None, context_kv=None):
     b, c, h, w = x.shape
     x_in = x
-    x = self.norm(x)
-    x = self.proj_in(x)
-    x = x.reshape(b, c, h*w).permute(0,2,1)
-    for block in self.transformer_blocks:
-      x = block(x, context=context)
-    x = x.permute(0,2,1).reshape(b, c, h, w)
-    ret = self.proj_out(x) + x_in
-    return ret
+    # channels last from the norm onward, so proj_in and proj_out are matmuls on (b,hw,c)
+    x = self.norm(x).reshape(b, c, h*w).permute(0,2,1)
+    x = conv1x1(self.proj_in, x)
+    for i,block in enumerate(self.transformer_blocks):
+      x = block(x, context=context, context_kv=None if context_kv is None else context_kv[i])
+    x = conv1x1(self.proj_out, x)
+    return x.permute(0,2,1).reshape(b, c, h, w) + x_in
 
 class Downsample:
   def __init__(self, channels):
@@ -266,15 +315,13 @@ class Upsample:
     self.conv = Conv2d(channels, channels, 3, padding=1)
 
   def __call__(self, x):
-    bs,c,py,px = x.shape
-    x = x.reshape(bs, c, py, 1, px, 1).expand(bs, c, py, 2, px, 2).reshape(bs, c, py*2, px*2)
-    return self.conv(x)
+    return self.conv(upsample_nearest(x))
 
 def timestep_embedding(timesteps, dim, max_period=10000):
   half = dim // 2
   freqs = np.exp(-math.log(max_period) * np.arange(0, half, dtype=np.float32) / half)
   args = timesteps * freqs
-  embedding = np.concatenate([np.cos(args), np.sin(args)])
+  embedding = np.concatenate([np.cos(args), np.sin(args)]).astype(np.float32)
   return Tensor(embedding).reshape(1, -1)
 
 class UNetModel:
@@ -323,14 +370,21 @@ class UNetModel:
       Conv2d(320, 4, kernel_size=3, padding=1)
     ]
 
-  def __call__(self, x, timesteps=None, context=None):
-    # TODO: real time embedding
-    t_emb = timestep_embedding(timesteps, 320)
-    emb = t_emb.sequential(self.time_embed)
+  def time_embedding(self, timesteps): return self.time_embed[2](self.time_embed[0](timestep_embedding(timesteps, 320)).silu())
+
+  def __call__(self, x, timesteps, context=None): return self.forward(x, self.time_embedding(timesteps), context)
+
+  # the cross attention k/v projections of the context, flattened in the order forward consumes them
+  def project_context(self, context):
+    return flatten([bb.project_context(context) for bb in flatten(self.input_blocks + [self.middle_block] + self.output_blocks) if isinstance(bb, SpatialTransformer)])
 
+  # the time embedding is an input here, so this can be captured by TinyJit and replayed for every timestep.
+  # the context can be passed as the context_kv from project_context instead, then it's not projected again on every call
+  def forward(self, x, emb, context=None, context_kv=None):
+    kv = iter(context_kv) if context_kv is not None else None
     def run(x, bb):
       if isinstance(bb, ResBlock): x = bb(x, emb)
-      elif isinstance(bb, SpatialTransformer): x = bb(x, context)
+      elif isinstance(bb, SpatialTransformer): x = bb(x, context, None if kv is None else [next(kv) for _ in bb.transformer_blocks])
       else: x = bb(x)
       return x
 
@@ -345,16 +399,18 @@ class UNetModel:
       x = run(x, bb)
     for i,b in enumerate(self.output_blocks):
       #print("output block", i)
-      x = x.cat(saved_inputs.pop(), dim=1)
+      # pop drops the last reference to the skip tensor. the concat feeds both the GroupNorm and the skip conv of the ResBlock,
+      # so realize it here to write it once instead of once per consumer
+      x = x.cat(saved_inputs.pop(), dim=1).realize()
       for bb in b:
         x = run(x, bb)
       x.realize()
-    return x.sequential(self.out)
+    return self.out[2](group_norm_silu(self.out[0], x))
 
 class CLIPMLP:
   def __init__(self):
-    self.fc1 = Linear(768, 3072)
-    self.fc2 = Linear(3072, 768)
+    self.fc1 = QLinear(768, 3072)
+    self.fc2 = QLinear(3072, 768)
 
   def __call__(self, hidden_states):
     hidden_states = self.fc1(hidden_states)
@@ -372,35 +428,29 @@ class CLIPAttention:
     self.v_proj = Linear(self.embed_dim, self.embed_dim)
     self.q_proj = Linear(self.embed_dim, self.embed_dim)
     self.out_proj = Linear(self.embed_dim, self.embed_dim)
+    self.qkv: Optional[Tuple[Tensor, Tensor]] = None  # set by pack_qkv
 
   def _shape(self, tensor, seq_len: int, bsz: int):
     return tensor.reshape(bsz, seq_len, self.num_heads, self.head_dim).permute(0,2,1,3)
 
-  def __call__(self, hidden_states, causal_attention_mask):
-    bsz, tgt_len, embed_dim = hidden_states.shape
-
-    query_states = self.q_proj(hidden_states) * self.scale
-    key_states = self._shape(self.k_proj(hidden_states), -1, bsz)
-    value_states = self._shape(self.v_proj(hidden_states), -1, bsz)
-
-    proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-    query_states = self._shape(query_states, tgt_len, bsz).reshape(*proj_shape)
-    key_states = key_states.reshape(*proj_shape)
-    src_len = key_states.shape[1]
-    value_states = value_states.reshape(*proj_shape)
+  def fold_scale(self): fold_attention_scale(self, self.q_proj)
 
-    attn_weights = query_states @ key_states.permute(0,2,1)
+  # one buffer per layer, slices of a stack across layers would each compile their own kernels
+  def pack_qkv(self):
+    self.qkv = (self.q_proj.weight.cat(self.k_proj.weight, self.v_proj.weight).realize(), self.q_proj.bias.cat(self.k_proj.bias, self.v_proj.bias).realize())
 
-    attn_weights = attn_weights.reshape(bsz, self.num_heads, tgt_len, src_len) + causal_attention_mask
-    attn_weights = attn_weights.reshape(bsz * self.num_heads, tgt_len, src_len)
-
-    attn_weights = attn_weights.softmax()
-
-    attn_output = attn_weights @ value_states
+  def __call__(self, hidden_states, causal_attention_mask):
+    bsz, tgt_len, embed_dim = hidden_states.shape
 
-    attn_output = attn_output.reshape(bsz, self.num_heads, tgt_len, self.head_dim)
-    attn_output = attn_output.permute(0,2,1,3)
-    attn_output = attn_output.reshape(bsz, tgt_len, embed_dim)
+    # q, k and v come from one matmul against the packed weights
+    if self.qkv is not None: qkv_weight, qkv_bias = self.qkv
+    else:
+      qkv_weight = self.q_proj.weight.cat(self.k_proj.weight, self.v_proj.weight)
+      qkv_bias = self.q_proj.bias.cat(self.k_proj.bias, self.v_proj.bias)
+    query_states, key_states, value_states = hidden_states.linear(qkv_weight.transpose(), qkv_bias).chunk(3, dim=-1)
+    query_states, key_states, value_states = [self._shape(y, tgt_len, bsz) for y in (query_states, key_states, value_states)]
+    attn_output = query_states.scaled_dot_product_attention(key_states, value_states, causal_attention_mask, scale=self.scale)
+    attn_output = attn_output.permute(0,2,1,3).reshape(bsz, tgt_len, embed_dim)
 
     attn_output = self.out_proj(attn_output)
     return attn_output
@@ -439,16 +489,24 @@ class CLIPTextEmbeddings:
     #self.position_ids = Tensor.empty(1, 77)  # what is this?
     self.token_embedding = {"weight": Tensor.empty(49408, 768)}
     self.position_embedding = {"weight": Tensor.empty(77, 768)}
+    self.token_table: Optional[np.ndarray] = None  # set by cache_token_table
+
+  # keeps a host copy of the token embedding table once the checkpoint is loaded, so an encode doesn't copy the whole table
+  # off the device to pick out its rows
+  def cache_token_table(self): self.token_table = self.token_embedding['weight'].numpy()
 
-  def __call__(self, input_ids, position_ids):
+  def __call__(self, input_ids):
     # TODO: actually support batches
-    inputs = np.zeros((1, len(input_ids), 49408), dtype=np.float32)
-    positions = np.zeros((1, len(position_ids), 77), dtype=np.float32)
-    for i,x in enumerate(input_ids): inputs[0][i][x] = 1
-    for i,x in enumerate(position_ids): positions[0][i][x] = 1
-    inputs_embeds = Tensor(inputs, device=self.token_embedding['weight'].device) @ self.token_embedding['weight']
-    position_embeddings = Tensor(positions, device=self.position_embedding['weight'].device) @ self.position_embedding['weight']
-    return inputs_embeds + position_embeddings
+    # gather the rows directly instead of multiplying a one-hot matrix with the whole embedding table
+    table = self.token_table if self.token_table is not None else self.token_embedding['weight'].numpy()
+    inputs_embeds = Tensor(table[np.asarray(input_ids)][None], device=self.token_embedding['weight'].device)
+    # the position ids are always 0..len-1, so the position embeddings are a slice of the table
+    return inputs_embeds + self.position_embedding['weight'][:len(input_ids)].reshape(1, len(input_ids), -1)
+
+# the mask only depends on the sequence length, so it's built once and reused by every encode
+@lru_cache(maxsize=None)
+def causal_mask(n:int, device:str) -> Tensor:
+  return Tensor(np.triu(np.full((1, 1, n, n), -np.inf, dtype=np.float32), k=1), device=device).realize()
 
 class CLIPTextTransformer:
   def __init__(self):
@@ -457,9 +515,8 @@ class CLIPTextTransformer:
     self.final_layer_norm = LayerNorm(768)
 
   def __call__(self, input_ids):
-    x = self.embeddings(input_ids, list(range(len(input_ids))))
-    causal_attention_mask = np.triu(np.ones((1,1,77,77), dtype=np.float32) * -np.inf, k=1)
-    x = self.encoder(x, Tensor(causal_attention_mask, device=x.device))
+    x = self.embeddings(input_ids)
+    x = self.encoder(x, causal_mask(len(input_ids), x.device))
     # x = self.encoder(x, Tensor.full((1, 1, 77, 77), float("-inf")).triu(1)) # TODO: Pending(#942)
     return self.final_layer_norm(x)
 
@@ -607,6 +664,8 @@ if __name__ == "__main__":
   parser.add_argument('--steps', type=int, default=5, help="Number of steps in diffusion")
   parser.add_argument('--prompt', type=str, default="a horse sized cat eating a bagel", help="Phrase to render")
   parser.add_argument('--out', type=str, default=os.path.join(tempfile.gettempdir(), "rendered.png"), help="Output filename")
+  parser.add_argument('--fp16', action='store_true', help="Keep the UNet and autoencoder weights in float16 and run the decoder activations in float16")
+  parser.add_argument('--int8', action='store_true', help="Quantize the CLIP MLP and UNet time embedding projections to int8")
   args = parser.parse_args()
 
   Tensor.no_grad = True
@@ -614,7 +673,35 @@ if __name__ == "__main__":
 
   # load in weights
   download_file('https://huggingface.co/CompVis/stable-diffusion-v-1-4-original/resolve/main/sd-v1-4.ckpt', FILENAME)
-  load_state_dict(model, torch_load(FILENAME)['state_dict'], strict=False)
+  # torch_load mmaps the checkpoint and every entry is a DISK tensor viewing into it. the model's weights are unrealized
+  # Tensor.empty, so load_state_dict replaces them instead of copying: each weight is read once straight into its device buffer
+  # (on CPU the buffer is the mmap'd view itself)
+  state_dict = torch_load(FILENAME)['state_dict']
+  if args.fp16: state_dict = {k:v.to(Device.DEFAULT).half() if k.startswith(("model.diffusion_model.", "first_stage_model.")) else v for k,v in state_dict.items()}
+  load_state_dict(model, state_dict, strict=False)
+  # everything below rewrites the loaded weights for inference. it adds tensors the checkpoint doesn't have (QLinear.scale,
+  # the packed qkv weights), so get_state_dict of the model no longer matches the checkpoint keys after this point
+  clip_layers, unet = model.cond_stage_model.transformer.text_model.encoder.layers, model.model.diffusion_model
+  unet_blocks = flatten(unet.input_blocks + [unet.middle_block] + unet.output_blocks)
+  if args.int8:
+    for l in clip_layers:
+      l.mlp.fc1.quantize()
+      l.mlp.fc2.quantize()
+    for b in unet_blocks:
+      if isinstance(b, ResBlock): b.emb_layers[1].quantize()
+  model.cond_stage_model.transformer.text_model.embeddings.cache_token_table()
+  # the softmax scales are folded into the query projections, so the attention kernels don't multiply every score by them.
+  # the folded weights round differently than scaled scores would, so outputs move by float rounding
+  for l in clip_layers:
+    l.self_attn.fold_scale()
+    l.self_attn.pack_qkv()
+  for b in unet_blocks:
+    if isinstance(b, SpatialTransformer):
+      for tb in b.transformer_blocks:
+        tb.attn1.fold_scale()
+        tb.attn1.pack_qkv()
+        tb.attn2.fold_scale()
+  for ae in (model.first_stage_model.encoder, model.first_stage_model.decoder): ae.mid.attn_1.fold_scale()
 
   # run through CLIP to get context
   tokenizer = ClipTokenizer()
@@ -629,10 +716,23 @@ if __name__ == "__main__":
   # done with clip model
   del model.cond_stage_model
 
+  # the unconditional and the conditional pass run as one batch of 2
+  contexts = unconditional_context.cat(context, dim=0).realize()
+  # the cross attention k/v only depend on the prompt, so they're projected once here and are inputs of every step
+  context_kv = [kv.realize() for kv in model.model.diffusion_model.project_context(contexts)]
+
+  # every step has the same shapes, so the UNet kernels are captured once and replayed
+  @TinyJit
+  def unet_step(latent, emb, *context_kv): return model.model.diffusion_model.forward(latent.expand(2, *latent.shape[1:]), emb, context_kv=context_kv).realize()
+
+  # the time embedding only depends on the timestep, so it's computed once per timestep. it's kept here and not on the model,
+  # so get_state_dict of the model only has the checkpoint tensors
+  time_embs = {}
   def get_model_output(latent, timesteps):
+    if (t := int(timesteps)) not in time_embs: time_embs[t] = model.model.diffusion_model.time_embedding(timesteps).realize()
     # put into diffuser
-    unconditional_latent = model.model.diffusion_model(latent, timesteps, unconditional_context).realize()
-    latent = model.model.diffusion_model(latent, timesteps, context).realize()
+    latents = unet_step(latent, time_embs[t], *context_kv)
+    unconditional_latent, latent = latents[0:1], latents[1:2]
 
     unconditional_guidance_scale = 7.5
     e_t = unconditional_latent + unconditional_guidance_scale * (latent - unconditional_latent)
@@ -675,8 +775,9 @@ if __name__ == "__main__":
     latent.realize()
 
   # upsample latent space to image with autoencoder
-  x = model.first_stage_model.post_quant_conv(1/0.18215 * latent)
-  x = model.first_stage_model.decoder(x)
+  # with --fp16 the decoder activations are float16 too, only the GroupNorm statistics and the attention run in float32
+  x = model.first_stage_model.post_quant_conv(1/0.18215 * (latent.half() if args.fp16 else latent))
+  x = model.first_stage_model.decoder(x).float()
 
   # make image correct size and scale
   x = (x + 1.0) / 2.0
@@ -426,6 +426,20 @@ class TestOps(unittest.TestCase):
     helper_test_op([(10,10,10)], lambda x: x.log_softmax(0), lambda x: x.log_softmax(0), atol=1e-7, grad_atol=1e-7)
     helper_test_op([(10,10,10)], lambda x: x.log_softmax(1), lambda x: x.log_softmax(1), atol=1e-7, grad_atol=1e-7)
     helper_test_op([(10,10,10)], lambda x: x.log_softmax(2), lambda x: x.log_softmax(2), atol=1e-7, grad_atol=1e-7)
+  def test_scaled_dot_product_attention(self):
+    helper_test_op([(4,2,10,16), (4,2,100,16), (4,2,100,16)], lambda x,y,z: torch.nn.functional.scaled_dot_product_attention(x,y,z),
+                   Tensor.scaled_dot_product_attention, atol=1e-4)
+    helper_test_op([(4,2,10,16), (4,2,100,16), (4,2,100,16), (1,1,10,100)], lambda x,y,z,m: torch.nn.functional.scaled_dot_product_attention(x,y,z,attn_mask=m),
+                   lambda x,y,z,m: x.scaled_dot_product_attention(y,z,attn_mask=m), atol=1e-4)
+    helper_test_op([(3,10,16), (3,20,16), (3,20,8)], lambda x,y,z: torch.nn.functional.scaled_dot_product_attention(x,y,z,scale=0.1),
+                   lambda x,y,z: x.scaled_dot_product_attention(y,z,scale=0.1), atol=1e-4)
+  def test_scaled_dot_product_attention_masked_block(self):
+    # every key of the first block is masked, so the running max starts at -inf
+    mask = np.zeros((1,1,1,300), dtype=np.float32)
+    mask[..., :140] = -np.inf
+    helper_test_op([(2,2,10,16), (2,2,300,16), (2,2,300,16)], lambda x,y,z: torch.nn.functional.scaled_dot_product_attention(x,y,z,attn_mask=torch.tensor(mask)),
+                   lambda x,y,z: x.scaled_dot_product_attention(y,z,attn_mask=Tensor(mask)), atol=1e-4)
+    with self.assertRaises(AssertionError): Tensor.ones(1,4,8).scaled_dot_product_attention(Tensor.ones(1,0,8), Tensor.ones(1,0,8))
   def test_tanh(self):
     helper_test_op([(45,65)], lambda x: x.tanh(), Tensor.tanh, atol=1e-6, grad_atol=1e-6)
     helper_test_op([(45,65)], lambda x: x.tanh(), Tensor.tanh, atol=1e-6, grad_atol=1e-6, a=-100)
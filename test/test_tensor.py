@@ -3,7 +3,7 @@ import torch
 import unittest
 from tinygrad.tensor import Tensor
 from tinygrad.ops import LoadOps, OpType
-from tinygrad.helpers import dtypes
+from tinygrad.helpers import dtypes, GlobalCounters
 from extra.gradcheck import numerical_jacobian, jacobian, gradcheck
 
 x_init = np.random.randn(1,3).astype(np.float32)
@@ -191,6 +191,14 @@ class TestTinygrad(unittest.TestCase):
     for _, dtype in dtypes.fields().items():
       assert dtype.itemsize == Tensor.randn(3, dtype=dtype).element_size(), f"Tensor.element_size() not matching Tensor.dtype.itemsize for {dtype}"
 
+  def test_empty_is_lazy(self):
+    # weights are created with Tensor.empty and replaced on load, so nothing is allocated until one is realized
+    mem_used = GlobalCounters.mem_used
+    t = Tensor.empty(1024, 1024)
+    assert t.lazydata.realized is None and GlobalCounters.mem_used == mem_used
+    t.assign(Tensor.ones(1024, 1024))
+    np.testing.assert_equal(t.numpy(), 1)
+
   def test_constant_fold(self):
     def helper_assert_all_const(op: OpType):
       if isinstance(op.op, LoadOps): assert op.op == LoadOps.CONST
@@ -528,7 +528,7 @@ class Tensor:
   def hardswish(self): return self * (self+3).relu6() * (1/6)
   def tanh(self): return 2.0 * ((2.0 * self).sigmoid()) - 1.0
   def hardtanh(self, min_val=-1, max_val=1): return self.clip(min_val, max_val)
-  def gelu(self): return 0.5 * self * (1 + (self * 0.7978845608 * (1 + 0.044715 * self * self)).tanh())
+  def gelu(self): return self * (self * 1.5957691216 * (1 + 0.044715 * self * self)).sigmoid()  # 0.5*(1+tanh(z)) == sigmoid(2*z)
   def quick_gelu(self): return self * (self * 1.702).sigmoid()
   def leakyrelu(self, neg_slope=0.01): return self.relu() - (-neg_slope*self).relu()
   def mish(self): return self * self.softplus().tanh()
@@ -647,6 +647,29 @@ class Tensor:
     y = (self - self.mean(axis, keepdim=True))
     return y.mul((y*y).mean(axis, keepdim=True).add(eps).rsqrt())
 
+  # https://arxiv.org/abs/2205.14135, keys are processed in blocks of 128 with an online softmax. this bounds the peak memory of the
+  # scores to (tgt_len, 128) per block, it doesn't reduce memory traffic: every block of scores is still written and the output
+  # is rescaled once per block. attention over 128 keys or less is a single block, the same kernels as a plain softmax
+  def scaled_dot_product_attention(self, key:Tensor, value:Tensor, attn_mask:Optional[Tensor]=None, scale:Optional[float]=None) -> Tensor:
+    assert key.shape[-2] > 0, "scaled_dot_product_attention needs at least one key"
+    scale, bs = 1/sqrt(self.shape[-1]) if scale is None else scale, 128
+    m: Optional[Tensor] = None
+    for i in range(0, key.shape[-2], bs):
+      s = self.dot(key[..., i:i+bs, :].transpose(-1, -2)) * scale
+      if attn_mask is not None: s = s + (attn_mask[..., i:i+bs] if attn_mask.shape[-1] != 1 else attn_mask)
+      # the softmax doesn't depend on the running max it's rescaled against, so the max needs no gradient
+      m_new = s.detach().max(-1, keepdim=True) if m is None else m.maximum(s.detach().max(-1, keepdim=True))
+      # a row with every key so far masked has a -inf max, exp(-inf - -inf) would be nan so it's rescaled against 0 instead
+      m_ref = (m_new == -float("inf")).where(0, m_new)
+      p = (s - m_ref).exp()
+      if m is None: l, o = p.sum(-1, keepdim=True), p.dot(value[..., i:i+bs, :])
+      else:
+        # rescale what was accumulated against the old running max
+        alpha = (m - m_ref).exp()
+        l, o = l * alpha + p.sum(-1, keepdim=True), o * alpha + p.dot(value[..., i:i+bs, :])
+      m = m_new
+    return o / l
+
   def batchnorm(self, weight:Optional[Tensor], bias:Optional[Tensor], mean:Tensor, invstd:Tensor) -> Tensor:
     x = (self - mean.reshape(shape=[1, -1, 1, 1]))
     if weight: x = x * weight.reshape(shape=[1, -1, 1, 1])